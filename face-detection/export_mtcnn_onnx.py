@@ -0,0 +1,55 @@
+# export_mtcnn_onnx.py
+"""
+Offline export of MTCNN's P/R/O-Net stages to ONNX.
+
+Writes pnet.onnx, rnet.onnx and onet.onnx to FD_ONNX_DIR. Deploy them with the
+component and set FD_ONNX_DIR so fd_component.py runs the stages on ONNX Runtime.
+"""
+import os
+import sys
+import logging
+import torch
+from facenet_pytorch import MTCNN
+
+# ---------- Configuration via Environment Variables ----------
+ONNX_DIR = os.getenv("FD_ONNX_DIR", "mtcnn_onnx")
+OPSET = int(os.getenv("ONNX_OPSET", "13"))
+# -------------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+def export(net, example, output_names, dynamic_axes, name):
+    path = os.path.join(ONNX_DIR, f"{name}.onnx")
+    torch.onnx.export(
+        net.eval(),
+        example,
+        path,
+        input_names=["input"],
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=OPSET,
+    )
+    logging.info(f"Exported {name} to {path}")
+
+def main():
+    os.makedirs(ONNX_DIR, exist_ok=True)
+    mtcnn = MTCNN()
+
+    # PNet is fully convolutional and runs on every pyramid scale
+    spatial = {0: "batch", 2: "height", 3: "width"}
+    export(mtcnn.pnet, torch.zeros(1, 3, 240, 240), ["reg", "prob"],
+           {"input": spatial, "reg": spatial, "prob": spatial}, "pnet")
+
+    # RNet/ONet see fixed-size candidate crops; only the batch varies
+    batch = {0: "batch"}
+    export(mtcnn.rnet, torch.zeros(1, 3, 24, 24), ["reg", "prob"],
+           {"input": batch, "reg": batch, "prob": batch}, "rnet")
+    export(mtcnn.onet, torch.zeros(1, 3, 48, 48), ["reg", "landmarks", "prob"],
+           {"input": batch, "reg": batch, "landmarks": batch, "prob": batch}, "onet")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,22 @@
 # fd_component.py
+import os
+# Pin OpenMP/MKL threads before torch is imported; defaults to all logical cores otherwise
+os.environ.setdefault("OMP_NUM_THREADS", "2")
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["OMP_NUM_THREADS"])
+
 import json
+import asyncio
 import base64
 import boto3
+from botocore.config import Config
 import logging
-import os
 import sys
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
 import numpy as np
+import torch
 from awscrt import mqtt
 from awsiot import mqtt_connection_builder
 from facenet_pytorch import MTCNN
@@ -30,11 +38,37 @@ CA_PATH = os.getenv("IOT_CA_PATH", "/greengrass/v2/rootCA.pem")
 SQS_REQUEST_QUEUE_URL = os.getenv("SQS_REQUEST_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/ACCOUNT_ID/your-req-queue")
 SQS_RESPONSE_QUEUE_URL = os.getenv("SQS_RESPONSE_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/ACCOUNT_ID/your-resp-queue")
 
-# Working directory for temp files
-TMP_DIR = os.getenv("FD_TMP_DIR", "/tmp/faces")
+# Run MTCNN's P/R/O-Net convs under BF16 autocast (only worthwhile on CPUs with AVX-512 BF16 / AMX);
+# box regression, NMS and cropping stay in FP32
+USE_BF16 = os.getenv("FD_USE_BF16", "0") == "1"
+
+# Prescreens that skip MTCNN on frames that can't contain a face.
+# Frames whose pixel std-dev is below this are treated as flat (0 disables).
+MIN_FRAME_STDDEV = float(os.getenv("FD_MIN_FRAME_STDDEV", "10"))
+# Also require an OpenCV Haar cascade hit before running MTCNN (needs opencv-python)
+HAAR_PRESCREEN = os.getenv("FD_HAAR_PRESCREEN", "0") == "1"
+
+# Max frames queued or in flight before new MQTT messages are dropped (bounds memory on the edge)
+MAX_PENDING_FRAMES = int(os.getenv("FD_MAX_PENDING_FRAMES", "8"))
+
+# Directory with pnet/rnet/onet.onnx from export_mtcnn_onnx.py; unset = eager PyTorch MTCNN
+ONNX_DIR = os.getenv("FD_ONNX_DIR", "")
 # -------------------------------------------------------------
 
-sqs = boto3.client("sqs", region_name=REGION)
+# Pooled keep-alive connections so repeated sends reuse the TLS session
+sqs = boto3.client(
+    "sqs",
+    region_name=REGION,
+    config=Config(
+        max_pool_connections=32,
+        retries={"max_attempts": 3, "mode": "adaptive"},
+        tcp_keepalive=True,
+    ),
+)
+
+# Match intra-op threads to the pinned OpenMP pool; inter-op parallelism is not used
+torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+torch.set_num_interop_threads(1)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -42,40 +76,143 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+class OrtNet(torch.nn.Module):
+    """Runs one MTCNN stage on ONNX Runtime behind the nn.Module call MTCNN expects."""
+
+    def __init__(self, model_path: str):
+        super().__init__()
+        import onnxruntime as ort
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.intra_op_num_threads = int(os.environ["OMP_NUM_THREADS"])
+        opts.inter_op_num_threads = 1
+        # Prefer providers with fused AVX2/AVX-512 conv kernels when they're installed
+        preferred = ["OpenVINOExecutionProvider", "DnnlExecutionProvider", "CPUExecutionProvider"]
+        providers = [p for p in preferred if p in ort.get_available_providers()]
+        self._session = ort.InferenceSession(model_path, sess_options=opts, providers=providers)
+        self._input = self._session.get_inputs()[0].name
+        # facenet-pytorch reads the stage dtype from next(net.parameters()); give it a float32 anchor
+        self._dtype = torch.nn.Parameter(torch.empty(0), requires_grad=False)
+
+    def forward(self, x):
+        outputs = self._session.run(None, {self._input: x.float().numpy()})
+        return tuple(torch.from_numpy(o) for o in outputs)
+
+class Bf16Net(torch.nn.Module):
+    """Runs one MTCNN stage's forward under BF16 autocast and hands FP32 outputs back to MTCNN."""
+
+    def __init__(self, net: torch.nn.Module):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            outputs = self.net(x)
+        return tuple(o.float() for o in outputs)
+
 class FaceDetection:
     def __init__(self):
         # CPU-only MTCNN is fine on edge
         self.mtcnn = MTCNN(image_size=240, margin=0, min_face_size=20)
+        if ONNX_DIR:
+            # Swap the conv stages for ONNX Runtime; MTCNN's pyramid, NMS and cropping are unchanged
+            self.mtcnn.pnet = OrtNet(os.path.join(ONNX_DIR, "pnet.onnx"))
+            self.mtcnn.rnet = OrtNet(os.path.join(ONNX_DIR, "rnet.onnx"))
+            self.mtcnn.onet = OrtNet(os.path.join(ONNX_DIR, "onet.onnx"))
+            self._check_onnx_stages()
+            logging.info(f"MTCNN stages running on ONNX Runtime from {ONNX_DIR}")
+        elif USE_BF16:
+            self.mtcnn.pnet = Bf16Net(self.mtcnn.pnet)
+            self.mtcnn.rnet = Bf16Net(self.mtcnn.rnet)
+            self.mtcnn.onet = Bf16Net(self.mtcnn.onet)
+        self._haar = None
+        if HAAR_PRESCREEN:
+            import cv2
+
+            self._haar = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
 
-    def detect_face_to_file(self, image_bytes, output_dir) -> str | None:
+    def _check_onnx_stages(self):
+        """Runs every ONNX stage once so a broken export fails at startup, not per frame."""
+        with torch.inference_mode():
+            # Full MTCNN path on a blank frame (PNet only, as no candidates survive)
+            self.mtcnn(Image.new("RGB", (240, 240)), return_prob=True)
+            # RNet/ONet only run on candidates, so exercise them directly
+            self.mtcnn.rnet(torch.zeros(1, 3, 24, 24))
+            self.mtcnn.onet(torch.zeros(1, 3, 48, 48))
+
+    def detect_face(self, image_bytes) -> np.ndarray | None:
         """
-        Runs face detection on image bytes and writes a normalized RGB face crop to output_dir.
-        Returns the saved file path or None if no face.
+        Runs face detection on image bytes.
+        Returns the normalized RGB face crop as a CHW uint8 array, or None if no face.
         """
-        img = Image.open(image_bytes).convert("RGB")
-        img_np = np.array(img)
-        img_pil = Image.fromarray(img_np)
+        img = Image.open(image_bytes)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
 
-        face_tensor, prob = self.mtcnn(img_pil, return_prob=True, save_path=None)
-        if face_tensor is None:
+        # Cheap no-face prescreens; a subsampled std-dev is enough to spot flat frames
+        if MIN_FRAME_STDDEV > 0 and np.asarray(img)[::4, ::4].std() < MIN_FRAME_STDDEV:
             return None
+        if self._haar is not None:
+            gray = np.asarray(img.convert("L"))
+            if len(self._haar.detectMultiScale(gray, scaleFactor=1.3, minNeighbors=5, minSize=(20, 20))) == 0:
+                return None
 
-        os.makedirs(output_dir, exist_ok=True)
-        # Normalize to [0, 255] and convert to PIL RGB
-        face_img = face_tensor - face_tensor.min()
-        denom = face_img.max() - face_img.min()
-        face_img = (face_img / denom * 255) if denom > 0 else face_img * 0
-        face_pil = Image.fromarray(face_img.byte().permute(1, 2, 0).numpy(), mode="RGB")
+        with torch.inference_mode():
+            # PIL input keeps MTCNN's bilinear crop resize
+            face_tensor, prob = self.mtcnn(img, return_prob=True, save_path=None)
+            if face_tensor is None:
+                return None
 
-        file_path = os.path.join(output_dir, "detected_face.jpg")
-        face_pil.save(file_path)
-        return file_path
+            # Normalize to [0, 255] in place; min/max come from one fused pass.
+            # A flat crop maps to all zeros.
+            face_tensor = face_tensor.float()
+            lo, hi = torch.aminmax(face_tensor)
+            face_tensor.sub_(lo).div_((hi - lo).clamp_min_(1e-8)).mul_(255).clamp_(0, 255)
+            return face_tensor.to(torch.uint8).numpy()
 
 fd = FaceDetection()
 
+# MTCNN already uses the pinned intra-op threads, so detections run one at a time
+detect_executor = ThreadPoolExecutor(max_workers=1)
+# Event loop owned by main(); MQTT callbacks hand work to it
+loop: asyncio.AbstractEventLoop | None = None
+
+# Frames accepted but not yet finished; beyond this new frames get a "Dropped" result
+pending_frames = threading.BoundedSemaphore(MAX_PENDING_FRAMES)
+
 def on_message_received(topic, payload, **kwargs):
+    # Runs on the awscrt I/O thread: hand off immediately so the MQTT client never blocks
     logging.info(f"MQTT message on '{topic}'")
+    if not pending_frames.acquire(blocking=False):
+        logging.warning(f"{MAX_PENDING_FRAMES} frames already pending; dropping message on '{topic}'")
+        asyncio.run_coroutine_threadsafe(reject_message(payload), loop)
+        return
+    asyncio.run_coroutine_threadsafe(handle_message(payload), loop)
+
+async def reject_message(payload):
+    """Sends a terminal 'Dropped' result so the client isn't left waiting on a shed frame."""
+    try:
+        message = json.loads(payload.decode("utf-8"))
+        request_id = message.get("request_id")
+        filename = message.get("filename")
+        if not request_id:
+            logging.warning("Dropped payload has no request_id; nothing to notify")
+            return
+        await asyncio.to_thread(
+            sqs.send_message,
+            QueueUrl=SQS_RESPONSE_QUEUE_URL,
+            MessageBody=json.dumps({
+                "request_id": request_id,
+                "filename": filename,
+                "result": "Dropped"
+            })
+        )
+    except Exception as e:
+        logging.error(f"Failed to report dropped frame: {e}", exc_info=True)
 
+async def handle_message(payload):
+    """Detects a face and enqueues the result; SQS puts for different frames overlap."""
     try:
         message = json.loads(payload.decode("utf-8"))
         encoded = message.get("encoded")
@@ -87,13 +224,13 @@ def on_message_received(topic, payload, **kwargs):
             return
 
         img_bytes = BytesIO(base64.b64decode(encoded))
-        os.makedirs(TMP_DIR, exist_ok=True)
-        detected_face_path = fd.detect_face_to_file(img_bytes, TMP_DIR)
+        face = await asyncio.get_running_loop().run_in_executor(detect_executor, fd.detect_face, img_bytes)
 
-        if detected_face_path is None:
+        if face is None:
             # Optional "bonus" behavior: short-circuit when no face
             logging.info("No face detected. Sending 'No-Face' to response queue.")
-            sqs.send_message(
+            await asyncio.to_thread(
+                sqs.send_message,
                 QueueUrl=SQS_RESPONSE_QUEUE_URL,
                 MessageBody=json.dumps({
                     "request_id": request_id,
@@ -103,20 +240,30 @@ def on_message_received(topic, payload, **kwargs):
             )
             return
 
-        with open(detected_face_path, "rb") as fh:
-            encoded_face = base64.b64encode(fh.read()).decode("utf-8")
-
+        # Shape lets the Lambda rebuild the raw crop (no JPEG re-encode)
         sqs_payload = {
             "request_id": request_id,
             "filename": filename,
-            "face": encoded_face
+            "shape": list(face.shape)
         }
-        sqs.send_message(QueueUrl=SQS_REQUEST_QUEUE_URL, MessageBody=json.dumps(sqs_payload))
+        await asyncio.to_thread(
+            sqs.send_message,
+            QueueUrl=SQS_REQUEST_QUEUE_URL,
+            MessageBody=json.dumps(sqs_payload),
+            # Crop bytes travel as a binary attribute; boto3 handles the wire encoding
+            MessageAttributes={"face": {"DataType": "Binary", "BinaryValue": face.tobytes()}}
+        )
         logging.info("Face detected; enqueued to request queue.")
     except Exception as e:
         logging.error(f"Processing error: {e}", exc_info=True)
+    finally:
+        pending_frames.release()
 
 def main():
+    global loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
     # Build mutual-TLS connection using Greengrass-provided certs
     mqtt_connection = mqtt_connection_builder.mtls_from_path(
         endpoint=IOT_ENDPOINT,
@@ -136,10 +283,13 @@ def main():
     logging.info("Subscription successful.")
 
     try:
-        threading.Event().wait()  # block forever
+        loop.run_forever()  # serve MQTT-triggered work until interrupted
     except KeyboardInterrupt:
         logging.info("Disconnecting MQTT.")
         mqtt_connection.disconnect().result()
+    finally:
+        detect_executor.shutdown(wait=False)
+        loop.close()
 
 if __name__ == "__main__":
     main()
@@ -1,13 +1,28 @@
 # fr_lambda.py
 import os
+# Pin OpenMP/MKL threads before torch is imported; defaults to all logical cores otherwise
+os.environ.setdefault("OMP_NUM_THREADS", "2")
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["OMP_NUM_THREADS"])
+
 import json
 import boto3
+from botocore.config import Config
 import base64
-import tempfile
+import hashlib
+from collections import OrderedDict
+from io import BytesIO
 import torch
 import numpy as np
 from PIL import Image
 
+# numba is optional; without it every gallery goes through torch.cdist.
+# Lambda's code directory is read-only, so the JIT cache lives in /tmp.
+os.environ.setdefault("NUMBA_CACHE_DIR", "/tmp/numba_cache")
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # If you load MTCNN elsewhere, leave it out here; recognition uses the ResNet.
 # from facenet_pytorch import MTCNN  # Not required for recognition
 
@@ -21,76 +36,243 @@ SQS_RESPONSE_QUEUE_URL = os.getenv(
 # Model artifacts baked into the Lambda package/container image
 MODEL_PATH = os.getenv("MODEL_PATH", "resnetV1.pt")
 MODEL_WT_PATH = os.getenv("MODEL_WT_PATH", "resnetV1_video_weights.pt")
+# Raw float32 gallery + names from migrate_gallery.py; memory-mapped instead of MODEL_WT_PATH when set
+GALLERY_PATH = os.getenv("GALLERY_PATH", "")
+GALLERY_NAMES_PATH = os.getenv("GALLERY_NAMES_PATH", "names.json")
+
+# Face crop size produced by the detection component (MTCNN image_size)
+FACE_SIZE = int(os.getenv("FACE_SIZE", "240"))
+
+# Run the ResNet under BF16 autocast (only worthwhile on CPUs with AVX-512 BF16 / AMX)
+USE_BF16 = os.getenv("FR_USE_BF16", "0") == "1"
+
+# Number of recent crop -> label results kept for redelivered messages
+LABEL_CACHE_SIZE = int(os.getenv("LABEL_CACHE_SIZE", "256"))
+
+# Galleries smaller than this use the numba kernel (when installed) instead of torch.cdist
+NUMBA_MAX_GALLERY = int(os.getenv("NUMBA_MAX_GALLERY", "32"))
+
+# send_message_batch accepts at most 10 entries per call
+SQS_MAX_BATCH = 10
 # -------------------------------------------------------------
 
-sqs = boto3.client("sqs", region_name=REGION)
+# Pooled keep-alive connections so repeated sends reuse the TLS session
+sqs = boto3.client(
+    "sqs",
+    region_name=REGION,
+    config=Config(
+        max_pool_connections=32,
+        retries={"max_attempts": 3, "mode": "adaptive"},
+        tcp_keepalive=True,
+    ),
+)
+
+# Match intra-op threads to the pinned OpenMP pool; inter-op parallelism is not used
+torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+torch.set_num_interop_threads(1)
+
+if njit is not None:
+    # Serial on purpose: B is usually 1 and N < NUMBA_MAX_GALLERY, so a thread pool would only add overhead
+    @njit(fastmath=True, cache=True)
+    def _l2_argmin(embs, gallery):
+        """Index of the nearest gallery row (squared L2) for each embedding row."""
+        out = np.empty(embs.shape[0], dtype=np.int64)
+        for b in range(embs.shape[0]):
+            best = 0.0
+            best_i = -1
+            for i in range(gallery.shape[0]):
+                s = 0.0
+                for j in range(gallery.shape[1]):
+                    d = embs[b, j] - gallery[i, j]
+                    s += d * d
+                if best_i < 0 or s < best:
+                    best = s
+                    best_i = i
+            out[b] = best_i
+        return out
+else:
+    _l2_argmin = None
 
 class FaceRecognition:
     def __init__(self):
         # Lazy-load model on first invocation to reduce cold start time on small images
         self._resnet = None
-        self._embeddings = None
+        self._gallery = None
         self._names = None
+        self._emb_dim = None
+        self._use_numba = False
+        # LRU of crop digest -> label, so SQS redeliveries skip the ResNet
+        self._label_cache = OrderedDict()
 
     def _load_models(self):
         if self._resnet is None:
-            # TorchScript model recommended for Lambda
-            self._resnet = torch.jit.load(MODEL_PATH, map_location="cpu").eval()
-        if self._embeddings is None or self._names is None:
-            saved = torch.load(MODEL_WT_PATH, map_location="cpu")
-            self._embeddings, self._names = saved[0], saved[1]
+            # Int8 models from quantize_resnet.py run on fbgemm (x86 VNNI kernels)
+            if "fbgemm" in torch.backends.quantized.supported_engines:
+                torch.backends.quantized.engine = "fbgemm"
+            # Use the simple executor so new shapes don't trigger re-profiling/recompiles
+            torch._C._jit_set_profiling_executor(False)
+            torch._C._jit_set_profiling_mode(False)
+            # TorchScript model recommended for Lambda; freezes (if not already) and folds conv/bn
+            resnet = torch.jit.load(MODEL_PATH, map_location="cpu").eval()
+            resnet = torch.jit.optimize_for_inference(resnet)
+            # Warm up so graph specialization happens at init, not in the SQS handler
+            dummy = torch.zeros(1, 3, FACE_SIZE, FACE_SIZE)
+            with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=USE_BF16):
+                for _ in range(2):
+                    self._emb_dim = resnet(dummy).shape[1]
+            self._resnet = resnet
+        if self._gallery is None or self._names is None:
+            if GALLERY_PATH:
+                with open(GALLERY_NAMES_PATH) as fh:
+                    self._names = json.load(fh)
+                # Copy-on-write mmap: no deserialize/memcpy, rows are paged in as cdist touches them
+                gallery = np.memmap(GALLERY_PATH, dtype=np.float32, mode="c")
+                if not self._names or gallery.size % len(self._names):
+                    raise ValueError(
+                        f"{GALLERY_PATH} holds {gallery.size} floats, not a multiple of "
+                        f"{len(self._names)} names in {GALLERY_NAMES_PATH}"
+                    )
+                self._gallery = torch.from_numpy(gallery.reshape(len(self._names), -1))
+            else:
+                saved = torch.load(MODEL_WT_PATH, map_location="cpu")
+                if isinstance(saved, dict):
+                    # {"embeddings": (N, D), "names": [...]} written by migrate_gallery.py
+                    self._gallery = saved["embeddings"].float().contiguous()
+                    self._names = saved["names"]
+                else:
+                    # Legacy [embeddings, names]: stack once into an (N, D) gallery
+                    self._gallery = torch.stack(
+                        [e.squeeze(0) if e.dim() > 1 else e for e in saved[0]]
+                    ).contiguous()
+                    self._names = saved[1]
+            if self._gallery.shape != (len(self._names), self._emb_dim):
+                raise ValueError(
+                    f"Gallery shape {tuple(self._gallery.shape)} does not match "
+                    f"{len(self._names)} names x {self._emb_dim}-d embeddings from {MODEL_PATH}"
+                )
+            # Small galleries skip PyTorch's dispatcher; compile now rather than on first request
+            self._use_numba = _l2_argmin is not None and len(self._names) < NUMBA_MAX_GALLERY
+            if self._use_numba:
+                _l2_argmin(np.zeros((1, self._gallery.shape[1]), dtype=np.float32), self._gallery.numpy())
 
-    def predict_name(self, face_img_path: str) -> str:
+    def _embed_and_label(self, faces: list[np.ndarray]) -> list[str]:
+        """Runs the ResNet and gallery search for a batch of CHW uint8 RGB face crops."""
         self._load_models()
 
-        face_pil = Image.open(face_img_path).convert("RGB")
-        face_np = np.array(face_pil, dtype=np.float32) / 255.0
-        face_np = np.transpose(face_np, (2, 0, 1))  # HWC -> CHW
-        face_tensor = torch.tensor(face_np, dtype=torch.float32).unsqueeze(0)
+        # One uint8 stack, then a single cast + in-place scale (no float64/float32 temporaries)
+        faces_tensor = torch.from_numpy(np.stack(faces)).to(torch.float32).div_(255.0)  # (B, 3, H, W)
 
         with torch.inference_mode():
-            emb = self._resnet(face_tensor).detach()
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=USE_BF16):
+                embs = self._resnet(faces_tensor)
+            embs = embs.float()  # gallery and cdist stay FP32
+            if self._use_numba:
+                idx = _l2_argmin(embs.numpy(), self._gallery.numpy()).tolist()
+            else:
+                # L2 distances from every face to every stored embedding in one call
+                idx = torch.cdist(embs, self._gallery).argmin(dim=1).tolist()
+        return [self._names[i] for i in idx]
+
+    def predict_names(self, faces: list[np.ndarray]) -> list[str]:
+        """Predicts identities for a batch of CHW uint8 RGB face crops."""
+        # Redelivered messages carry identical crops; only run inference on unseen ones
+        keys = [hashlib.blake2b(face, digest_size=16).digest() for face in faces]
+        labels = [self._label_cache.get(key) for key in keys]
+        misses = [i for i, label in enumerate(labels) if label is None]
+
+        if misses:
+            for i, label in zip(misses, self._embed_and_label([faces[i] for i in misses])):
+                labels[i] = label
+                self._label_cache[keys[i]] = label
+        for key in keys:
+            self._label_cache.move_to_end(key)
+        while len(self._label_cache) > LABEL_CACHE_SIZE:
+            self._label_cache.popitem(last=False)
+        return labels
 
-        # L2 distances to stored embeddings
-        dists = [torch.dist(emb, e).item() for e in self._embeddings]
-        idx = int(np.argmin(dists))
-        return self._names[idx]
+    def predict_name(self, face: np.ndarray) -> str:
+        """Predicts the identity for a CHW uint8 RGB face crop."""
+        return self.predict_names([face])[0]
 
 recognizer = FaceRecognition()
 
-def lambda_handler(event, context):
+def _face_bytes(record, payload) -> bytes:
+    """Returns the raw face crop from the "face" binary attribute (or the legacy body field)."""
+    attr = record.get("messageAttributes", {}).get("face")
+    if attr is not None:
+        # Lambda delivers binary attribute values base64-encoded in the event JSON
+        return base64.b64decode(attr["binaryValue"])
+    return base64.b64decode(payload["face"])
+
+def _decode_face(record, payload) -> np.ndarray:
+    """Returns the CHW uint8 face crop carried by an SQS record."""
+    face_bytes = _face_bytes(record, payload)
+    if "shape" in payload:
+        face = np.frombuffer(face_bytes, dtype=np.uint8).reshape(payload["shape"])
+    else:
+        # Older components send an encoded (JPEG) crop; decode it from memory rather than /tmp
+        face_pil = Image.open(BytesIO(face_bytes)).convert("RGB")
+        face = np.ascontiguousarray(np.asarray(face_pil).transpose(2, 0, 1))  # HWC -> CHW
+    # Reject odd-sized crops here so one bad record can't break the whole batch's np.stack
+    if face.shape != (3, FACE_SIZE, FACE_SIZE):
+        raise ValueError(f"Expected a (3, {FACE_SIZE}, {FACE_SIZE}) face crop, got {face.shape}")
+    return face
+
+def _process_batch(records) -> list[str]:
     """
-    Triggered by SQS (request queue). For each record:
-      - decodes face image,
-      - predicts identity,
-      - sends {request_id, result} to response queue.
+    Runs one ResNet forward pass and one send_message_batch for up to SQS_MAX_BATCH records.
+    Returns the messageIds whose results were not delivered, so SQS can redrive them.
     """
-    # SQS batch events
-    for record in event.get("Records", []):
+    message_ids, request_ids, faces = [], [], []
+    for record in records:
         try:
             payload = json.loads(record["body"])
-            request_id = payload["request_id"]
-            face_b64 = payload["face"]
+            faces.append(_decode_face(record, payload))
+            request_ids.append(payload["request_id"])
+            message_ids.append(record["messageId"])
+        except Exception as e:
+            # Log and drop: a malformed record won't decode any better on redelivery
+            print(f"[ERROR] Failed to decode record: {e}")
 
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg", dir="/tmp") as tmpf:
-                tmpf.write(base64.b64decode(face_b64))
-                face_path = tmpf.name
+    if not faces:
+        return []
 
-            label = recognizer.predict_name(face_path)
+    try:
+        labels = recognizer.predict_names(faces)
+        entries = [
+            {"Id": str(i), "MessageBody": json.dumps({"request_id": request_id, "result": label})}
+            for i, (request_id, label) in enumerate(zip(request_ids, labels))
+        ]
+        resp = sqs.send_message_batch(QueueUrl=SQS_RESPONSE_QUEUE_URL, Entries=entries)
+    except Exception as e:
+        print(f"[ERROR] Failed to process batch: {e}")
+        return message_ids
 
-            result_msg = {
-                "request_id": request_id,
-                "result": label
-            }
-            sqs.send_message(QueueUrl=SQS_RESPONSE_QUEUE_URL, MessageBody=json.dumps(result_msg))
-        except Exception as e:
-            # Log and continue to next record. Let SQS redrive handle retries if configured.
-            print(f"[ERROR] Failed to process record: {e}")
-        finally:
-            try:
-                if "face_path" in locals() and os.path.exists(face_path):
-                    os.remove(face_path)
-            except OSError:
-                pass
-
-    return {"statusCode": 200, "body": json.dumps({"message": "Face recognition completed."})}
+    failed_ids = []
+    for failed in resp.get("Failed", []):
+        i = int(failed["Id"])
+        print(f"[ERROR] Failed to send result {request_ids[i]}: {failed.get('Message')}")
+        failed_ids.append(message_ids[i])
+    return failed_ids
+
+def lambda_handler(event, context):
+    """
+    Triggered by SQS (request queue). For each batch of records:
+      - decodes face crops,
+      - predicts identities in a single forward pass,
+      - sends {request_id, result} messages to response queue in one batch call.
+    Records whose results weren't delivered are reported in batchItemFailures
+    (requires ReportBatchItemFailures on the event source mapping) so SQS redrives
+    only those; redelivered crops then hit the label cache instead of the ResNet.
+    """
+    # SQS batch events
+    records = event.get("Records", [])
+    failed_ids = []
+    for start in range(0, len(records), SQS_MAX_BATCH):
+        failed_ids += _process_batch(records[start:start + SQS_MAX_BATCH])
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"message": "Face recognition completed."}),
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_ids]
+    }
@@ -0,0 +1,51 @@
+# migrate_gallery.py
+"""
+One-off migration of the gallery weights file to a contiguous tensor.
+
+Rewrites the legacy [list_of_embeddings, names] pair saved in MODEL_WT_PATH as
+{"embeddings": (N, D) float32 tensor, "names": [str, ...]}, which fr_lambda.py
+loads without re-stacking on every cold start. Also writes the embeddings as a
+raw float32 file plus a JSON names list, which fr_lambda.py memory-maps instead.
+"""
+import os
+import sys
+import json
+import logging
+import torch
+
+# ---------- Configuration via Environment Variables ----------
+MODEL_WT_PATH = os.getenv("MODEL_WT_PATH", "resnetV1_video_weights.pt")
+# Defaults to rewriting the file in place
+OUTPUT_PATH = os.getenv("GALLERY_OUT_PATH", MODEL_WT_PATH)
+# Raw (N, D) float32 embeddings and their names, for the mmap loader
+GALLERY_PATH = os.getenv("GALLERY_PATH", "gallery.f32")
+GALLERY_NAMES_PATH = os.getenv("GALLERY_NAMES_PATH", "names.json")
+# -------------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+def main():
+    saved = torch.load(MODEL_WT_PATH, map_location="cpu")
+    if isinstance(saved, dict):
+        logging.info(f"{MODEL_WT_PATH} is already migrated; only writing the raw gallery.")
+        embeddings, names = saved["embeddings"].float().contiguous(), list(saved["names"])
+    else:
+        embeddings = torch.stack([e.flatten() for e in saved[0]]).float().contiguous()
+        names = list(saved[1])
+        if embeddings.shape[0] != len(names):
+            logging.error(f"Embedding count {embeddings.shape[0]} does not match name count {len(names)}")
+            sys.exit(1)
+        torch.save({"embeddings": embeddings, "names": names}, OUTPUT_PATH)
+        logging.info(f"Saved {tuple(embeddings.shape)} gallery to {OUTPUT_PATH}")
+
+    embeddings.numpy().tofile(GALLERY_PATH)
+    with open(GALLERY_NAMES_PATH, "w") as fh:
+        json.dump(names, fh)
+    logging.info(f"Wrote raw gallery to {GALLERY_PATH} and names to {GALLERY_NAMES_PATH}")
+
+if __name__ == "__main__":
+    main()
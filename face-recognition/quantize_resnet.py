@@ -0,0 +1,107 @@
+# quantize_resnet.py
+"""
+Offline int8 quantization of the face-recognition ResNet.
+
+Loads the weights of the deployed TorchScript model (MODEL_PATH) into an eager
+InceptionResnetV1, calibrates static (FX graph mode) int8 quantization on a
+directory of face crops, reports FP32-vs-int8 agreement, then traces and freezes
+the result to TorchScript. Set MODEL_PATH for fr_lambda.py to the output file to use it.
+"""
+import os
+import sys
+import logging
+import numpy as np
+import torch
+from PIL import Image
+from facenet_pytorch import InceptionResnetV1
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# ---------- Configuration via Environment Variables ----------
+# Deployed FP32 model whose weights are quantized, and the gallery it was enrolled with
+MODEL_PATH = os.getenv("MODEL_PATH", "resnetV1.pt")
+MODEL_WT_PATH = os.getenv("MODEL_WT_PATH", "resnetV1_video_weights.pt")
+# Directory of RGB face crops (as produced by the detection component)
+CALIB_DIR = os.getenv("CALIB_DIR", "calibration_faces")
+OUTPUT_PATH = os.getenv("QUANT_MODEL_PATH", "resnetV1_int8.pt")
+FACE_SIZE = int(os.getenv("FACE_SIZE", "240"))
+# fbgemm targets x86 (AVX2 / AVX-512 VNNI), which is what Lambda runs on
+ENGINE = os.getenv("QUANT_ENGINE", "fbgemm")
+# -------------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    stream=sys.stdout,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+def load_face(path: str) -> torch.Tensor:
+    """Loads a face crop with the same preprocessing as FaceRecognition.predict_name."""
+    face_pil = Image.open(path).convert("RGB").resize((FACE_SIZE, FACE_SIZE))
+    face_np = np.array(face_pil, dtype=np.float32) / 255.0
+    face_np = np.transpose(face_np, (2, 0, 1))  # HWC -> CHW
+    return torch.tensor(face_np, dtype=torch.float32).unsqueeze(0)
+
+def load_gallery():
+    """Returns the (N, D) gallery and names from MODEL_WT_PATH, or (None, None) if absent."""
+    if not os.path.exists(MODEL_WT_PATH):
+        return None, None
+    saved = torch.load(MODEL_WT_PATH, map_location="cpu")
+    if isinstance(saved, dict):
+        return saved["embeddings"].float(), saved["names"]
+    return torch.stack([e.flatten() for e in saved[0]]).float(), saved[1]
+
+def report_agreement(fp32_embs: torch.Tensor, int8_embs: torch.Tensor):
+    """Logs cosine drift and nearest-label agreement between FP32 and int8 embeddings."""
+    cos = torch.nn.functional.cosine_similarity(fp32_embs, int8_embs, dim=1)
+    logging.info(f"FP32 vs int8 cosine similarity: mean {cos.mean():.4f}, min {cos.min():.4f}")
+
+    gallery, names = load_gallery()
+    if gallery is None:
+        logging.warning(f"{MODEL_WT_PATH} not found; skipping nearest-label agreement")
+        return
+    fp32_idx = torch.cdist(fp32_embs, gallery).argmin(dim=1)
+    int8_idx = torch.cdist(int8_embs, gallery).argmin(dim=1)
+    matches = int((fp32_idx == int8_idx).sum())
+    logging.info(f"Nearest-label agreement: {matches}/{len(fp32_idx)} ({matches / len(fp32_idx):.1%})")
+
+def main():
+    files = sorted(
+        os.path.join(CALIB_DIR, f) for f in os.listdir(CALIB_DIR)
+        if f.lower().endswith((".jpg", ".jpeg", ".png"))
+    )
+    if not files:
+        logging.error(f"No calibration images found in {CALIB_DIR}")
+        sys.exit(1)
+    faces = [load_face(path) for path in files]
+
+    # Quantize the deployed weights, not a fresh pretrained download, so embeddings match the gallery
+    reference = torch.jit.load(MODEL_PATH, map_location="cpu").eval()
+    state = reference.state_dict()
+    model = InceptionResnetV1().eval()
+    if "logits.weight" in state:
+        # Pretrained exports carry the classifier head; attach it so strict loading succeeds.
+        # classify stays False, so forward still returns embeddings.
+        model.logits = torch.nn.Linear(512, state["logits.weight"].shape[0])
+    model.load_state_dict(state)
+
+    torch.backends.quantized.engine = ENGINE
+    example = torch.zeros(1, 3, FACE_SIZE, FACE_SIZE)
+
+    prepared = prepare_fx(model, get_default_qconfig_mapping(ENGINE), example_inputs=(example,))
+    logging.info(f"Calibrating on {len(files)} face crops from {CALIB_DIR}")
+    with torch.no_grad():
+        for face in faces:
+            prepared(face)
+
+    quantized = convert_fx(prepared).eval()
+    with torch.no_grad():
+        fp32_embs = torch.cat([reference(face) for face in faces])
+        int8_embs = torch.cat([quantized(face) for face in faces])
+        report_agreement(fp32_embs, int8_embs)
+        scripted = torch.jit.freeze(torch.jit.trace(quantized, example))
+    torch.jit.save(scripted, OUTPUT_PATH)
+    logging.info(f"Saved int8 TorchScript model to {OUTPUT_PATH}")
+
+if __name__ == "__main__":
+    main()